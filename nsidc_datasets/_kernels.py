@@ -0,0 +1,92 @@
+"""Numeric kernels for the preprocessors.
+
+These fuse the elementwise range-mask and flag-extraction loops into a
+single pass over the array, instead of the boolean-temporary plus select
+sequence that the equivalent xarray/NumPy expressions produce.  When
+numba is installed the kernels are JIT-compiled to parallel single-pass
+loops; otherwise plain NumPy fallbacks with identical semantics are
+used.  numba is an optional dependency.
+
+The kernels are meant to be called through
+``xr.apply_ufunc(..., dask="parallelized")`` so they run once per chunk.
+
+The selects here deliberately use ``np.where`` on the raw arrays rather
+than ``xr.where``/``DataArray.where``: the xarray forms run broadcasting
+and coordinate alignment that is unnecessary for these elementwise masks,
+where both operands always share identical coordinates, and are
+measurably slower.  New masking code should follow the same pattern.
+"""
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+
+    @njit(parallel=True, cache=True)
+    def mask_range(a, lo, hi, fill):
+        """Returns a with values outside [lo, hi] replaced by fill"""
+        out = np.empty_like(a)
+        aflat = a.ravel()
+        oflat = out.ravel()
+        for i in prange(aflat.size):
+            v = aflat[i]
+            oflat[i] = v if (v >= lo) and (v <= hi) else fill
+        return out
+
+    @njit(parallel=True, cache=True)
+    def extract_flags(a, lo, hi, scale, offset):
+        """Returns the packed flag values embedded in a, 0 where valid
+
+        a is converted back to packed integers with scale and offset and
+        compared against the packed range [lo, hi].  Flags are returned
+        as uint8, which holds the full 0-255 packed flag space at a
+        quarter of the width of the default integer dtype.
+        """
+        out = np.empty(a.shape, np.uint8)
+        aflat = a.ravel()
+        oflat = out.ravel()
+        for i in prange(aflat.size):
+            packed = (aflat[i] - offset) / scale
+            oflat[i] = np.uint8(packed) if (packed < lo) or (packed > hi) else 0
+        return out
+
+    @njit(parallel=True, cache=True)
+    def extract_flags_packed(a, lo, hi):
+        """Returns the flag values embedded in packed-integer a, 0 where
+        valid.  For inputs opened with mask_and_scale=False, so no
+        scale/offset arithmetic is needed."""
+        out = np.empty(a.shape, np.uint8)
+        aflat = a.ravel()
+        oflat = out.ravel()
+        for i in prange(aflat.size):
+            v = aflat[i]
+            oflat[i] = np.uint8(v) if (v < lo) or (v > hi) else 0
+        return out
+
+else:
+
+    def mask_range(a, lo, hi, fill):
+        """Returns a with values outside [lo, hi] replaced by fill"""
+        return np.where((a >= lo) & (a <= hi), a, fill)
+
+    def extract_flags(a, lo, hi, scale, offset):
+        """Returns the packed flag values embedded in a, 0 where valid
+
+        a is converted back to packed integers with scale and offset and
+        compared against the packed range [lo, hi].
+        """
+        packed = (a - offset) / scale
+        # Select before casting: NaN fill pixels fail both comparisons
+        # and become 0, so they never reach the uint8 cast
+        return np.where((packed < lo) | (packed > hi),
+                        packed, 0.).astype(np.uint8)
+
+    def extract_flags_packed(a, lo, hi):
+        """Returns the flag values embedded in packed-integer a, 0 where
+        valid.  For inputs opened with mask_and_scale=False, so no
+        scale/offset arithmetic is needed."""
+        return np.where((a < lo) | (a > hi), a, 0).astype(np.uint8)
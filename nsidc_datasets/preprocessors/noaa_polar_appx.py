@@ -1,4 +1,5 @@
 """Preprocessor for NOAA Polar APPx"""
+import functools
 import re
 
 import numpy as np
@@ -8,6 +9,33 @@ import rioxarray
 
 from nsidc_projections.grid import AVHRR_EASEGridNorth25km
 
+# Matches the observation hour and minute in the id global attribute,
+# e.g. "..._nhem_0400_d..."
+_TIME_RE = re.compile(r"hem_(\d{2})(\d{2})_d")
+
+
+@functools.lru_cache(maxsize=1)
+def _build_xy():
+    """Builds the projected x and y coordinate DataArrays and the grid
+    WKT string.  These are identical for every granule on the AVHRR
+    EASE-Grid, so they are built once and reused across files."""
+    x, y = AVHRR_EASEGridNorth25km.get_coordinates()
+    x = xr.DataArray(x, coords=[x], dims=['x'], name='x',
+                     attrs={'units': 'm',
+                            'long_name': 'x coordinate of projection',
+                            'standard_name': 'projection_x_coordinate',
+                            'grid_mapping': 'lambert_azimuthal_equal_area',
+                            'axis': 'X'})
+    y = xr.DataArray(y, coords=[y], dims=['y'], name='y',
+                     attrs={'units': 'm',
+                            'long_name': 'y coordinate of projection',
+                            'standard_name': 'projection_y_coordinate',
+                            'grid_mapping': 'lambert_azimuthal_equal_area',
+                            'axis': 'Y'})
+    wkt = AVHRR_EASEGridNorth25km.crs.to_cf()['crs_wkt']
+    return x, y, wkt
+
+
 def add_spatial_coords(ds):
     """Add spatial coordinates to a dataset
 
@@ -25,46 +53,45 @@ def add_spatial_coords(ds):
     1. Reset longitude and latitude coordinates to data variables
     2. Rename spatial dimensions to x and y
     3. Adds x and y coordinates in AVHRR EASE Grid 25 km
-    4. Adds required attributes"""
-    
-    # Move longitude and latitude to data_vars
-    ds = ds.reset_coords(['longitude', 'latitude'])  # remove lat and lon as coordinates
+    4. Adds required attributes
+
+    All four modifications are applied while building a single new
+    Dataset, so xarray rebuilds its indexes and variable mappings once
+    instead of once per operation."""
+
+    x, y, wkt = _build_xy()
 
     # Rename horizontal dimensions - the original dimensions are
     # incorrectly named; columns are up-down, and rows left-right.
     # Normally x would be the column dimension and y the row dimensions.
     # The mapping used below is different from that to correct the mistake.
-    ds = ds.rename({'columns': 'y', 'rows': 'x'})  # rename to x and y - these will be set as coordinates
-
-    # Generate projected x and y coordinates
-    x, y = AVHRR_EASEGridNorth25km.get_coordinates()
-    x = xr.DataArray(x, coords=[x], dims=['x'], name='x', 
-                     attrs={'units': 'm', 
-                            'long_name': 'x coordinate of projection', 
-                            'standard_name': 'projection_x_coordinate',
-                            'grid_mapping': 'lambert_azimuthal_equal_area',
-                            'axis': 'X'})
-    y = xr.DataArray(y, coords=[y], dims=['y'], name='y', 
-                     attrs={'units': 'm', 
-                            'long_name': 'y coordinate of projection', 
-                            'standard_name': 'projection_y_coordinate',
-                            'grid_mapping': 'lambert_azimuthal_equal_area',
-                            'axis': 'Y'})
-
-    # Assign x and y coordinates
-    ds = ds.assign_coords({'x': x, 'y': y})
+    dim_map = {'columns': 'y', 'rows': 'x'}
+
+    # Collect variables with renamed dimensions, demoting longitude and
+    # latitude to data variables.  Variables are rebuilt from ._data so
+    # lazily indexed backend arrays are passed through unloaded.
+    coord_names = set(ds.coords) - {'longitude', 'latitude'}
+    data_vars = {}
+    coords = {'x': x, 'y': y}
+    for name, var in ds.variables.items():
+        dims = tuple(dim_map.get(d, d) for d in var.dims)
+        new_var = xr.Variable(dims, var._data, var.attrs, var.encoding)
+        if name in coord_names:
+            coords[name] = new_var
+        else:
+            data_vars[name] = new_var
+
+    ds = xr.Dataset(data_vars, coords=coords, attrs=ds.attrs)
 
     # Add WKT to crs definition
-    ds.crs.attrs['crs_wkt'] = AVHRR_EASEGridNorth25km.crs.to_cf()['crs_wkt']
+    ds.crs.attrs['crs_wkt'] = wkt
 
     return ds
 
 
 def get_time_from_id(ds):
     """Returns hour and minute from the id global attribute"""
-    p = re.compile(r"hem_(\d{2})(\d{2})_d")
-    hour, minute = p.search(ds.attrs["id"]).groups()
-    return int(hour), int(minute)
+    return tuple(map(int, _TIME_RE.search(ds.attrs["id"]).groups()))
 
 
 def fix_time_coords(ds):
@@ -89,10 +116,11 @@ def fix_time_coords(ds):
     """
     ds = ds.swap_dims({'Time': 'time'})  # rename Time dimension
 
-    # Fix the time coordinate -
+    # Fix the time coordinate - fold the observation time and the 1 day
+    # offset into a single scalar so only one coordinate update runs
     hour, minute = get_time_from_id(ds)
-    ds['time'] = (ds['time'] + np.timedelta64(hour, "h") +
-                  np.timedelta64(minute, "m") - np.timedelta64(1, "D"))
+    delta = np.timedelta64(hour * 3600 + minute * 60 - 86400, "s")
+    ds['time'] = ds['time'] + delta
     return xr.decode_cf(ds)
 
 
@@ -104,7 +132,7 @@ def fix_dimensions_order(ds):
 
 def drop_vars(ds, data_vars):
     """Drops variables not in data_vars"""
-    these_vars = [var for var in datasets[0].data_vars if var not in data_vars]
+    these_vars = list(ds.data_vars.keys() - set(data_vars))
     return ds.drop_vars(these_vars)
 
 
@@ -1,16 +1,21 @@
 """Preprocess code for NOAA/NSIDC CDR of Passive Microwave Sea Ice Concentration
 G02202"""
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 import xarray as xr
 
-from nsidc_datasets.preprocessors.nsidc_0051 import extract_mask, update_sic
+from nsidc_datasets.preprocessors.nsidc_0051 import (
+    extract_mask,
+    get_encoding_spec,
+    update_sic,
+)
 
 
 def preprocess(
         ds: xr.Dataset,
         keep_vars: List[str]=None,
         rename: Dict={"cdr_seaice_conc": "sic"},
+        chunks: Optional[Dict]=None,
         ) -> xr.Dataset:
     """Preprocessor for NOAA/NSIDC CDR of Passive Microwave
     Sea Ice Concentration (G02202).  Returns a preprocessed
@@ -19,11 +24,15 @@ def preprocess(
     Arguments
     ---------
     ds : xarray.Dataset containing a single CDR granule
-    keep_vars : list of strings containing data variables to keep
-        NotImplemented
+    keep_vars : list of strings containing data variables to keep.  By
+        default only cdr_seaice_conc is kept.  Variables not kept are
+        dropped before any values are loaded.
     rename : dict of old_name: new_name key-values pairs.  By default
-        cdr_seaice_conc is renamed to sic
-        NotImplemented
+        cdr_seaice_conc is renamed to sic.  Entries for variables not in
+        the dataset are ignored.
+    chunks : optional dict of dimension name to chunk size.  When given,
+        the dataset is chunked before the mask and sic variables are
+        derived so the array math stays lazy and memory-bounded.
 
     Returns
     -------
@@ -34,22 +43,34 @@ def preprocess(
     1. time, x and y dimensions are renamed to conform to CF-Conventions
     2. mask flags in the sea ice concentration variable are extracted to separate mask DataArray
     3. set mask flag values in sic variable to missing
-    4. Drop unrequired data variables: only data variables listed in data_vars are
+    4. Drop unrequired data variables: only data variables listed in keep_vars are
        retained.  By default this is just cdr_seaice_conc
+    5. Variables are renamed following rename
     """
 
-    data_vars = list(ds.data_vars.keys())
-    
     icecon_var = "cdr_seaice_conc"
-    
+
     # Rename dimensions to fit CF-Conventions best practices
     ds = ds.rename_vars({"xgrid": "x", "ygrid": "y"})
     ds = ds.swap_dims({"tdim": "time"})
 
-    ds["mask"] = extract_mask(ds[icecon_var])
-    ds["sic"] = update_sic(ds[icecon_var])
+    if chunks:
+        ds = ds.chunk(chunks)
+
+    spec = get_encoding_spec(ds[icecon_var])
+
+    ds["mask"] = extract_mask(ds[icecon_var], spec=spec)
+    ds[icecon_var] = update_sic(ds[icecon_var], new_name=icecon_var,
+                                spec=spec)
+
+    # Drop data variables unless requested in keep_vars, keeping the
+    # mask added above
+    keep = set(keep_vars) if keep_vars else {icecon_var}
+    ds = ds.drop_vars(set(ds.data_vars) - keep - {"mask"})
 
-    # Drop data variables unless listed in data_vars
-    ds = ds.drop_vars(data_vars)
+    # Rename requested variables that are present
+    rename = {k: v for k, v in (rename or {}).items() if k in ds.variables}
+    if rename:
+        ds = ds.rename(rename)
 
     return ds
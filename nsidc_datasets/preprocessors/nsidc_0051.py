@@ -1,9 +1,61 @@
 """Code to preprocess NSIDC passive microwave datasets"""
-from typing import Union, List, Dict
+import functools
+
+from collections import namedtuple
+from typing import Union, List, Dict, Optional, Tuple
 
 import xarray as xr
 import numpy as np
 
+from nsidc_datasets._kernels import extract_flags, extract_flags_packed, mask_range
+
+# Attributes that only describe the packed flag encoding and are dropped
+# from the sea ice concentration variable
+_SIC_DROP_ATTRS = frozenset({"legacy_binary_header", "flag_values",
+                             "flag_meanings", "comment"})
+
+# Snapshot of the encoding values shared by extract_mask and update_sic:
+# scale_factor, add_offset, the scaled valid range, and the packed
+# _FillValue.  Built once per file so the helpers do not repeat the
+# encoding and attribute lookups.
+EncodingSpec = namedtuple("EncodingSpec",
+                          ["scale", "offset", "vmin", "vmax", "fill"])
+
+
+def get_encoding_spec(da: xr.DataArray) -> "EncodingSpec":
+    """Returns an EncodingSpec for a data variable
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+
+    Returns
+    -------
+    EncodingSpec with scale_factor, add_offset, the scaled valid range
+    and the packed _FillValue
+    """
+    valid_min, valid_max = get_actual_valid_range(da)
+    # With mask_and_scale=False xarray leaves the CF packing attributes
+    # in attrs rather than encoding, so fall back to attrs
+    return EncodingSpec(
+        da.encoding.get("scale_factor", da.attrs.get("scale_factor", 1.)),
+        da.encoding.get("add_offset", da.attrs.get("add_offset", 0.)),
+        valid_min, valid_max,
+        da.encoding.get("_FillValue", da.attrs.get("_FillValue")))
+
+
+@functools.lru_cache(maxsize=64)
+def _compute_valid_range(scale_factor: float,
+                         add_offset: float,
+                         valid_range: Tuple) -> Tuple[float, float]:
+    """Scales a packed valid range.  Cached because every granule of a
+    multi-file dataset carries the same encoding, so the scaling only
+    needs to run once per distinct encoding."""
+    valid_min, valid_max = valid_range
+    return (valid_min * scale_factor + add_offset,
+            valid_max * scale_factor + add_offset)
+
+
 def get_icecon_variable_name(ds: xr.Dataset) -> str:
     """Returns name of ICECON variable
 
@@ -38,58 +90,93 @@ def get_actual_valid_range(da: xr.DataArray):
     """
     if 'valid_range' not in da.attrs:
         raise KeyError(f"No `valid_range` attribute for {da.name}")
-    valid_range = da.attrs['valid_range']
 
-    scale_factor = da.encoding.get("scale_factor", 1.)
-    add_offset = da.encoding.get("add_offset", 0.)
-    valid_range = valid_range * scale_factor + add_offset
-    
-    return valid_range
+    scale_factor = da.encoding.get("scale_factor",
+                                   da.attrs.get("scale_factor", 1.))
+    add_offset = da.encoding.get("add_offset",
+                                 da.attrs.get("add_offset", 0.))
+
+    return _compute_valid_range(scale_factor, add_offset,
+                                tuple(np.asarray(da.attrs['valid_range']).tolist()))
 
 
-def extract_mask(da: xr.Dataset):
+def extract_mask(da: xr.DataArray, spec: EncodingSpec=None,
+                 squeeze: bool=False):
     """Extracts mask values from a data variable and returns a mask
     DataArray.
 
     Arguments
     ---------
     da : data variable with mask flags embedded
+    spec : optional EncodingSpec, as returned by get_encoding_spec.
+        Pass this when calling from a preprocessor so the encoding is
+        parsed once per file.
+    squeeze : drop singleton dimensions from the mask.  Default is
+        False: per-file preprocessing keeps the singleton time dimension
+        so a later concat does not have to broadcast it back.
 
     Returns
     -------
     mask variable
+
+    The mask is computed in a single pass in the packed integer space:
+    values are converted back to packed integers and compared against the
+    packed `valid_range`, so no intermediate float arrays are materialized.
+    If da is still packed integers (opened with mask_and_scale=False) the
+    scale/offset round trip is skipped and only an integer compare runs.
+    On dask-backed inputs the computation stays lazy.
     """
 
-    valid_min, valid_max = get_actual_valid_range(da)
+    if spec is None:
+        spec = get_encoding_spec(da)
+
+    raw_min = (spec.vmin - spec.offset) / spec.scale
+    raw_max = (spec.vmax - spec.offset) / spec.scale
+
+    if np.issubdtype(da.dtype, np.integer):
+        mask = xr.apply_ufunc(extract_flags_packed, da,
+                              kwargs={"lo": raw_min, "hi": raw_max},
+                              dask="parallelized", output_dtypes=[np.uint8])
+    else:
+        mask = xr.apply_ufunc(extract_flags, da,
+                              kwargs={"lo": raw_min, "hi": raw_max,
+                                      "scale": spec.scale, "offset": spec.offset},
+                              dask="parallelized", output_dtypes=[np.uint8])
 
-    scale_factor = da.encoding.get("scale_factor", 1.)
-    add_offset = da.encoding.get("add_offset", 0.)
-    
-    mask = da.where((da < valid_min) | (da > valid_max), 0)
-    mask = (mask - add_offset) / scale_factor
-    mask = mask.astype(int)
-    
     # Add attributes to mask
     mask.attrs = {
         "long_name": "mask",
         "standard_name": "mask",
         "units": None,
-        "flag_values": np.insert(da.attrs.get('flag_values', []), 0, [0]),
+        "flag_values": np.fromiter((0, *da.attrs.get('flag_values', [])),
+                                   dtype=np.uint8),
         "flag_meanings": " ".join(["valid", da.attrs.get('flag_meanings', '')]),
         }
 
-    mask.encoding = da.encoding
-    
-    return mask.squeeze()
+    # Drop the sic scale/offset and fill from the mask encoding: the
+    # flag values are already integers, and re-packing them through the
+    # sic codec on write would fail
+    mask.encoding = {k: v for k, v in da.encoding.items()
+                     if k not in ("scale_factor", "add_offset", "_FillValue")}
+    mask.encoding["dtype"] = "u1"
+
+    if squeeze:
+        mask = mask.squeeze()
 
+    return mask
 
-def update_sic(sic: xr.DataArray, new_name: str="sic") -> xr.DataArray:
+
+def update_sic(sic: xr.DataArray, new_name: str="sic",
+               spec: EncodingSpec=None) -> xr.DataArray:
     """Extract and recodes sic field
 
     Arguments
     ---------
     sic : xr.DataArray containing sea ice concentration
     new_name : new name for sic DataArray.  Default is sic
+    spec : optional EncodingSpec, as returned by get_encoding_spec.
+        Pass this when calling from a preprocessor so the encoding is
+        parsed once per file.
 
     Returns
     -------
@@ -103,17 +190,32 @@ def update_sic(sic: xr.DataArray, new_name: str="sic") -> xr.DataArray:
     3. valid_range attribute is set to actual valid range
     4. DataArray is renamed to new_name.  Default is "sic"
     """
-    valid_min, valid_max = get_actual_valid_range(sic)
+    if spec is None:
+        spec = get_encoding_spec(sic)
+    valid_min, valid_max = spec.vmin, spec.vmax
     encoding = sic.encoding
-    
-    sic = sic.where((sic >= valid_min) & (sic <= valid_max))
-
-    for attname in ["legacy_binary_header", "flag_values", 
-                    "flag_meanings", "comment"]:
-        try:
-            del sic.attrs[attname]
-        except Exception as err:
-            print(f"Cound not find {attname}, skipping deletion")
+
+    if np.issubdtype(sic.dtype, np.integer) and spec.fill is not None:
+        # Still packed (opened with mask_and_scale=False): mask with the
+        # packed _FillValue so the array stays integer and readers decode
+        # the fill through the scale/offset encoding on write/read.
+        lo = (valid_min - spec.offset) / spec.scale
+        hi = (valid_max - spec.offset) / spec.scale
+        kwargs = {"lo": lo, "hi": hi, "fill": spec.fill}
+        out_dtype = sic.dtype
+    else:
+        kwargs = {"lo": valid_min, "hi": valid_max, "fill": np.nan}
+        # NaN fill upcasts integer input, so declare the dtype the
+        # kernel actually computes
+        out_dtype = (sic.dtype if np.issubdtype(sic.dtype, np.floating)
+                     else np.float64)
+
+    sic = xr.apply_ufunc(mask_range, sic, kwargs=kwargs,
+                         dask="parallelized", output_dtypes=[out_dtype],
+                         keep_attrs=True)
+
+    sic.attrs = {k: v for k, v in sic.attrs.items()
+                 if k not in _SIC_DROP_ATTRS}
     sic.attrs["valid_range"] = [valid_min, valid_max]
     
     sic = sic.rename(new_name)
@@ -129,12 +231,15 @@ def create_sensor(da):
     return sensor_id
 
     
-def preprocess(ds: xr.Dataset):
+def preprocess(ds: xr.Dataset, chunks: Optional[Dict]=None):
     """Preprocess NSIDC-0051 for building larger dataset
 
     Arguments
     ---------
     ds : xarray dataset
+    chunks : optional dict of dimension name to chunk size.  When given,
+        the dataset is chunked before the mask and sic variables are
+        derived so the array math stays lazy and memory-bounded.
 
     Return
     ------
@@ -149,18 +254,23 @@ def preprocess(ds: xr.Dataset):
     4. Updates and copies encoding
     """
 
+    if chunks:
+        ds = ds.chunk(chunks)
+
     icecon_var = get_icecon_variable_name(ds)
     sensor_id = icecon_var.split('_')[0]  # Get the sensor name from the variable
 
     icecon_encoding = ds[icecon_var].encoding
 
-    ds["mask"] = extract_mask(ds[icecon_var])
-    ds["sic"] = update_sic(ds[icecon_var])
+    spec = get_encoding_spec(ds[icecon_var])
+
+    ds["mask"] = extract_mask(ds[icecon_var], spec=spec)
+    ds["sic"] = update_sic(ds[icecon_var], spec=spec)
     ds["sensor"] = create_sensor(ds[icecon_var])
     
     # Drop original *_ICECON variable
-    ds.drop_var(icecon_var)
-    
+    ds = ds.drop_vars([icecon_var])
+
     return ds
 
 